@@ -1,25 +1,43 @@
 import re
 import json
+from functools import lru_cache
 from pathlib import Path
 from io import BytesIO
-from typing import Dict, Tuple, Optional
+from numbers import Real
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
 
 import pandas as pd
 import streamlit as st
 
-from github_storage import github_get_json, github_put_json
+try:
+    from python_calamine import CalamineWorkbook
+
+    HAS_CALAMINE = True
+except ImportError:  # fallback para openpyxl/xlrd
+    HAS_CALAMINE = False
+
+from github_storage import dumps_json, github_get_json, github_put_file
 
 FATURAMENTO_OPCOES = ["", "AMHPDF", "HOSPITAL", "DIRETO"]
+FATURAMENTO_DTYPE = pd.CategoricalDtype(categories=FATURAMENTO_OPCOES, ordered=False)
 DEFAULT_DATA_PATH = "data/convenios_faturamento.json"
 
+# únicas colunas do relatório usadas no processamento
+COLUNAS_USADAS = ["Nr. Guia", "Operadora", "Valor Total"]
+
+_RE_PAREN = re.compile(r"\s*\([^)]*\)\s*")
+_RE_WS = re.compile(r"\s+")
+_RE_TOTAL = re.compile(r"total\s*r\$\s*(.*)$", re.IGNORECASE)
+
 
-def normalize_convenio(s: str) -> str:
-    if s is None:
-        return ""
-    s = str(s).strip()
-    s = re.sub(r"\s*\([^)]*\)\s*", "", s)  # remove (1001)
-    s = re.sub(r"\s+", " ", s)  # normaliza espaços
-    return s
+def normalize_convenio(operadora: pd.Series) -> pd.Series:
+    """
+    Chave do convênio a partir da coluna Operadora (já com strip): remove códigos
+    entre parênteses e normaliza espaços. Ex.: 'BRADESCO - DIRETO(1001)' vira 'BRADESCO - DIRETO'.
+    """
+    s = operadora.str.replace(_RE_PAREN, "", regex=True)  # remove (1001)
+    s = s.str.replace(_RE_WS, " ", regex=True)  # normaliza espaços
+    return s.fillna("")
 
 
 def parse_brl_value(x) -> float:
@@ -40,30 +58,58 @@ def parse_brl_value(x) -> float:
         return 0.0
 
 
-def find_header_and_total_row(raw: pd.DataFrame) -> Tuple[int, Optional[int], Optional[float]]:
+def parse_brl_series(col: pd.Series) -> pd.Series:
+    """Versão vetorizada de parse_brl_value: números passam direto, textos viram float."""
+    # coluna só com números (comum com calamine): nada de máscaras nem de string
+    if col.dtype == object:
+        col = col.infer_objects()
+    if pd.api.types.is_numeric_dtype(col):
+        return col.fillna(0.0).astype("float64")
+
+    # máscaras pelo tipo de cada célula, como em parse_brl_value (o resto vale 0.0);
+    # .str não serve aqui porque falha em colunas só com números
+    is_num = col.map(lambda v: isinstance(v, Real)).astype(bool)
+    is_text = col.map(lambda v: isinstance(v, str)).astype(bool)
+
+    num = pd.to_numeric(col.where(is_num), errors="coerce")
+
+    s = col.where(is_text).astype("string")
+    s = s.str.replace("R$", "", regex=False).str.strip()
+    s = s.str.replace(".", "", regex=False).str.replace(",", ".", regex=False)
+    txt = pd.to_numeric(s, errors="coerce")
+
+    return num.where(is_num, txt.where(is_text)).fillna(0.0).astype("float64")
+
+
+def find_header_and_total_row(
+    rows: Iterable[Sequence[Any]],
+) -> Tuple[int, Optional[int], Optional[float], List[Any]]:
+    """
+    Percorre as linhas uma única vez e para assim que acha o cabeçalho e o total.
+    Devolve (linha do cabeçalho, linha do total, valor do total, valores do cabeçalho).
+    """
     header_idx = None
+    header_row: List[Any] = []
     total_idx = None
     total_val = None
 
-    # acha a linha do cabeçalho
-    for i in range(len(raw)):
-        row = raw.iloc[i]
-        first = row.iloc[0]
-        if isinstance(first, str) and first.strip().lower() == "atendimento":
-            joined = " | ".join([str(v) for v in row.values if pd.notna(v)])
-            if "nr. guia" in joined.lower() or "nº guia" in joined.lower():
-                header_idx = i
-                break
-
-    # acha a linha do total
-    for i in range(len(raw)):
-        row = raw.iloc[i]
-        for v in row.values:
-            if isinstance(v, str) and "total r$" in v.lower():
+    for i, row in enumerate(rows):
+        if header_idx is None:
+            # acha a linha do cabeçalho
+            first = row[0] if len(row) else None
+            if isinstance(first, str) and first.strip().lower() == "atendimento":
+                joined = " | ".join([str(v) for v in row if pd.notna(v)])
+                if "nr. guia" in joined.lower() or "nº guia" in joined.lower():
+                    header_idx = i
+                    header_row = list(row)
+            continue
+
+        # acha a linha do total (sempre depois do cabeçalho)
+        for v in row:
+            m = _RE_TOTAL.search(v) if isinstance(v, str) else None
+            if m:
                 total_idx = i
-                m = re.search(r"total\s*r\$\s*(.*)$", v, flags=re.IGNORECASE)
-                if m:
-                    total_val = parse_brl_value(m.group(1))
+                total_val = parse_brl_value(m.group(1))
                 break
         if total_idx is not None:
             break
@@ -71,39 +117,90 @@ def find_header_and_total_row(raw: pd.DataFrame) -> Tuple[int, Optional[int], Op
     if header_idx is None:
         raise ValueError("Não consegui identificar a linha de cabeçalho do relatório.")
 
-    return header_idx, total_idx, total_val
+    return header_idx, total_idx, total_val, header_row
 
 
-def parse_atendimentos(file_bytes: bytes, filename: str = "") -> Tuple[pd.DataFrame, Optional[float]]:
-    engine = "xlrd" if filename.lower().endswith(".xls") else "openpyxl"
-    raw = pd.read_excel(BytesIO(file_bytes), engine=engine, header=None)
+def read_excel_raw(file_bytes: bytes, filename: str = "", **kwargs) -> pd.DataFrame:
+    """Leitura sem calamine: xlrd para .xls, openpyxl para .xlsx."""
+    if filename.lower().endswith(".xls"):
+        return pd.read_excel(BytesIO(file_bytes), engine="xlrd", **kwargs)
 
-    header_idx, total_idx, report_total = find_header_and_total_row(raw)
+    return pd.read_excel(
+        BytesIO(file_bytes),
+        engine="openpyxl",
+        engine_kwargs={"read_only": True, "data_only": True},
+        **kwargs,
+    )
 
-    header_row = raw.iloc[header_idx]
-    col_map = {j: str(v).strip() for j, v in header_row.items() if pd.notna(v) and str(v).strip() != ""}
-    wanted_cols = list(col_map.keys())
 
-    start = header_idx + 1
-    end = total_idx if total_idx is not None else len(raw)
+def _calamine_cell(v: Any) -> Any:
+    # mesma conversão do pd.read_excel: célula vazia vira NaN e float inteiro vira int
+    if v == "":
+        return float("nan")
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    return v
+
+
+def _calamine_region(
+    rows: List[List[Any]], start: int, end: Optional[int], usecols: List[int], names: List[str]
+) -> pd.DataFrame:
+    """Monta o DataFrame da região de dados (linhas start:end) só com as colunas usadas."""
+    region = rows[start:end]
+    data = {nome: [_calamine_cell(r[j]) for r in region] for j, nome in zip(usecols, names)}
+    return pd.DataFrame(data, dtype=object)
 
-    df = raw.iloc[start:end, wanted_cols].copy()
-    df.rename(columns=col_map, inplace=True)
 
-    df["Operadora"] = df["Operadora"].astype(str).str.strip()
-    df["ConvenioKey"] = df["Operadora"].apply(normalize_convenio)
-    df["Valor Total"] = df["Valor Total"].apply(parse_brl_value)
+def parse_atendimentos(file_bytes: bytes, filename: str = "") -> Tuple[pd.DataFrame, Optional[float]]:
+    # a aba é decodificada uma única vez; a busca do cabeçalho/total e a região de dados
+    # saem das mesmas linhas (posições absolutas a partir de A1, como no pd.read_excel)
+    if HAS_CALAMINE:
+        sheet = CalamineWorkbook.from_filelike(BytesIO(file_bytes)).get_sheet_by_index(0)
+        rows = sheet.to_python(skip_empty_area=False)
+        raw = None
+    else:
+        raw = read_excel_raw(file_bytes, filename=filename, header=None, dtype=object)
+        rows = raw.itertuples(index=False, name=None)
+
+    header_idx, total_idx, report_total, header_values = find_header_and_total_row(rows)
+
+    hdr = pd.Series(header_values, dtype=object).astype("string").str.strip()
+    mask = (hdr.notna() & (hdr != "")).to_numpy(dtype=bool)
+    col_map = dict(zip(hdr.index[mask].tolist(), hdr[mask].tolist()))
+
+    posicoes: Dict[str, int] = {}
+    for j, nome in col_map.items():
+        posicoes.setdefault(nome, j)
+    faltando = [c for c in COLUNAS_USADAS if c not in posicoes]
+    if faltando:
+        raise ValueError(f"Colunas não encontradas no cabeçalho do relatório: {', '.join(faltando)}.")
+
+    # só a região de dados (entre o cabeçalho e o total) e só as colunas usadas,
+    # na ordem do arquivo
+    usecols = sorted(posicoes[c] for c in COLUNAS_USADAS)
+    names = [col_map[j] for j in usecols]
+    start = header_idx + 1
+    if raw is None:
+        df = _calamine_region(rows, start, total_idx, usecols, names)
+    else:
+        df = raw.iloc[start:total_idx, usecols].set_axis(names, axis=1).reset_index(drop=True)
 
-    df = df[~((df["Nr. Guia"].isna()) & (df["Valor Total"] == 0))]
+    df["Operadora"] = df["Operadora"].astype("string").str.strip()
+    df["ConvenioKey"] = normalize_convenio(df["Operadora"]).astype("category")
+    df["Valor Total"] = parse_brl_series(df["Valor Total"])
+
+    # remove linhas vazias (sem guia e sem valor) com uma única máscara em numpy
+    guia = df["Nr. Guia"].to_numpy()
+    valor = df["Valor Total"].to_numpy()
+    df = df.iloc[~(pd.isna(guia) & (valor == 0.0))]
 
     return df, report_total
 
 
-def load_convenios_mapping() -> Dict[str, str]:
+@st.cache_data(ttl=300, show_spinner=False)
+def load_convenios_mapping(repo: Optional[str], path: str, branch: str) -> Dict[str, str]:
+    """Cadastro de convênios; fica em cache por 5 min (limpo a cada salvamento)."""
     token = st.secrets.get("GITHUB_TOKEN", None)
-    repo = st.secrets.get("GITHUB_REPO", None)
-    branch = st.secrets.get("GITHUB_BRANCH", "main")
-    path = st.secrets.get("CONVENIOS_PATH", DEFAULT_DATA_PATH)
 
     if token and repo:
         data = github_get_json(repo=repo, path=path, token=token, branch=branch, default={})
@@ -126,27 +223,48 @@ def save_convenios_mapping(mapping: Dict[str, str]) -> None:
 
     cleaned = {k: (v if v in FATURAMENTO_OPCOES else "") for k, v in mapping.items() if k}
 
+    # serializa uma vez só (mesmo conteúdo local e no GitHub)
+    blob = dumps_json(cleaned)
+
     # salva local
     Path(path).parent.mkdir(parents=True, exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(cleaned, f, ensure_ascii=False, indent=2)
+    Path(path).write_bytes(blob)
 
     # salva no GitHub (persistente)
     if token and repo:
-        github_put_json(
+        st.session_state["_convenios_sha"] = github_put_file(
             repo=repo,
             path=path,
             token=token,
             branch=branch,
-            data=cleaned,
+            content_bytes=blob,
             commit_message="Atualiza cadastro de convênios (faturamento)",
+            sha=st.session_state.get("_convenios_sha"),
         )
 
+    load_convenios_mapping.clear()
 
-def format_brl(v: float) -> str:
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def totais_por_guia_csv(_df_guia: pd.DataFrame, conteudo_hash: int) -> bytes:
+    """
+    CSV dos totais por guia; só é refeito quando conteudo_hash muda.
+    O DataFrame não entra na chave (o Streamlit só amostra linhas de tabelas grandes).
+    """
+    return _df_guia.to_csv(index=False, lineterminator="\n").encode("utf-8")
+
+
+@lru_cache(maxsize=512)
+def _format_brl_cached(v: float) -> str:
     return f"R$ {v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
 
 
+def format_brl(v: float) -> str:
+    # arredonda antes para que valores iguais em centavos usem a mesma entrada do cache
+    # (+ 0.0 transforma -0.0 em 0.0, que teriam o mesmo hash)
+    return _format_brl_cached(round(float(v), 2) + 0.0)
+
+
 @st.dialog("Resumo do relatório", width="medium")
 def resumo_dialog(resumo: Dict[str, float], report_total: Optional[float], calc_total: float):
     cols = st.columns(2)
@@ -177,7 +295,11 @@ def main():
     tab_proc, tab_conv, tab_help = st.tabs(["🧾 Processar relatório", "🏷️ Convênios", "❓ Ajuda"])
 
     if "convenios_mapping" not in st.session_state:
-        st.session_state.convenios_mapping = load_convenios_mapping()
+        st.session_state.convenios_mapping = load_convenios_mapping(
+            repo=st.secrets.get("GITHUB_REPO", None),
+            path=st.secrets.get("CONVENIOS_PATH", DEFAULT_DATA_PATH),
+            branch=st.secrets.get("GITHUB_BRANCH", "main"),
+        )
 
     mapping = st.session_state.convenios_mapping
 
@@ -187,8 +309,12 @@ def main():
         st.write("Cadastre uma vez. Nos próximos relatórios, o app reaproveita automaticamente.")
 
         df_map = pd.DataFrame(
-            sorted([(k, v) for k, v in mapping.items()], key=lambda x: x[0].lower()),
-            columns=["Convênio (chave)", "Faturamento"],
+            {"Convênio (chave)": list(mapping.keys()), "Faturamento": list(mapping.values())}
+        ).sort_values(
+            "Convênio (chave)",
+            key=lambda col: col.astype("string").str.lower(),
+            kind="stable",
+            ignore_index=True,
         )
 
         edited = st.data_editor(
@@ -208,11 +334,10 @@ def main():
         col1, col2 = st.columns([1, 3])
         with col1:
             if st.button("💾 Salvar cadastro", type="primary"):
-                new_map = {
-                    str(r["Convênio (chave)"]).strip(): str(r["Faturamento"]).strip()
-                    for _, r in edited.iterrows()
-                    if str(r["Convênio (chave)"]).strip()
-                }
+                keys = edited["Convênio (chave)"].astype("string").str.strip().fillna("")
+                vals = edited["Faturamento"].astype("string").str.strip().fillna("")
+                mask = keys.ne("")
+                new_map = dict(zip(keys[mask], vals[mask]))
                 st.session_state.convenios_mapping = new_map
                 save_convenios_mapping(new_map)
                 st.success("Cadastro salvo!")
@@ -238,7 +363,7 @@ def main():
             )
 
             convenios_arquivo = sorted(df["ConvenioKey"].dropna().astype(str).unique().tolist())
-            novos = [c for c in convenios_arquivo if c not in mapping]
+            novos = [c for c in convenios_arquivo if c and c not in mapping]
 
             if novos:
                 st.warning(f"Encontrados {len(novos)} convênios ainda sem faturamento cadastrado.")
@@ -258,27 +383,32 @@ def main():
                 )
 
                 if st.button("💾 Salvar novos convênios"):
-                    for _, r in edited_novos.iterrows():
-                        k = str(r["Convênio (chave)"]).strip()
-                        v = str(r["Faturamento"]).strip()
-                        if k and k not in mapping:
-                            mapping[k] = v
+                    keys = edited_novos["Convênio (chave)"].astype("string").str.strip().fillna("")
+                    vals = edited_novos["Faturamento"].astype("string").str.strip().fillna("")
+                    mask = keys.ne("") & ~keys.isin(list(mapping))
+                    mapping.update(dict(zip(keys[mask], vals[mask])))
                     st.session_state.convenios_mapping = mapping
                     save_convenios_mapping(mapping)
                     st.success("Novos convênios salvos!")
 
             df_guia = (
-                df.groupby(["Nr. Guia", "ConvenioKey"], as_index=False)["Valor Total"].sum()
+                df.groupby(["Nr. Guia", "ConvenioKey"], as_index=False, observed=True)["Valor Total"].sum()
                 .rename(columns={"ConvenioKey": "Convênio", "Valor Total": "Total da Guia"})
             )
-            df_guia["Faturamento"] = df_guia["Convênio"].map(mapping).fillna("")
+            # valores fora das opções (ou sem cadastro) contam como não vinculados
+            faturamento = df_guia["Convênio"].map(mapping).astype(object)
+            df_guia["Faturamento"] = faturamento.where(faturamento.isin(FATURAMENTO_OPCOES), "").astype(
+                FATURAMENTO_DTYPE
+            )
 
-            calc_total = float(df_guia["Total da Guia"].sum())
+            # uma única agregação por meio de faturamento ("" = não vinculado)
+            por_faturamento = df_guia.groupby("Faturamento", sort=False, observed=True)["Total da Guia"].sum()
+            calc_total = float(por_faturamento.sum())
             resumo = {
-                "AMHPDF": float(df_guia.loc[df_guia["Faturamento"] == "AMHPDF", "Total da Guia"].sum()),
-                "HOSPITAL": float(df_guia.loc[df_guia["Faturamento"] == "HOSPITAL", "Total da Guia"].sum()),
-                "DIRETO": float(df_guia.loc[df_guia["Faturamento"] == "DIRETO", "Total da Guia"].sum()),
-                "OUTROS": float(df_guia.loc[df_guia["Faturamento"] == "", "Total da Guia"].sum()),
+                "AMHPDF": float(por_faturamento.get("AMHPDF", 0.0)),
+                "HOSPITAL": float(por_faturamento.get("HOSPITAL", 0.0)),
+                "DIRETO": float(por_faturamento.get("DIRETO", 0.0)),
+                "OUTROS": float(por_faturamento.get("", 0.0)),
             }
 
             st.divider()
@@ -300,7 +430,9 @@ def main():
             with colB:
                 st.download_button(
                     "⬇️ Baixar totais por guia (CSV)",
-                    data=df_guia.to_csv(index=False).encode("utf-8"),
+                    data=totais_por_guia_csv(
+                        df_guia, conteudo_hash=int(pd.util.hash_pandas_object(df_guia).sum())
+                    ),
                     file_name="totais_por_guia.csv",
                     mime="text/csv",
                 )
@@ -1,37 +1,68 @@
 import base64
-import json
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple
 
+import orjson
 import requests
 
 GITHUB_API = "https://api.github.com"
 
+# (repo, path, branch) -> (ETag, resultado do último GET), para GET condicional
+_ETAG_CACHE: Dict[Tuple[str, str, str], Tuple[str, Dict[str, Any]]] = {}
 
-def _headers(token: str) -> Dict[str, str]:
-    return {
-        "Authorization": f"Bearer {token}",
+
+# sessão compartilhada: reaproveita a conexão (keep-alive) entre GET e PUT
+_SESSION = requests.Session()
+_SESSION.headers.update(
+    {
         "Accept": "application/vnd.github+json",
         "X-GitHub-Api-Version": "2022-11-28",
     }
+)
+
+
+def _headers(token: str) -> Dict[str, str]:
+    return {"Authorization": f"Bearer {token}"}
 
 
 def github_get_file(repo: str, path: str, token: str, branch: str = "main") -> Dict[str, Any]:
     """
     Obtém metadados e conteúdo de um arquivo no repo via Contents API.
     Repo no formato: "usuario/repositorio"
+    Usa If-None-Match com o ETag do último GET; em 304 devolve o resultado anterior.
     """
     url = f"{GITHUB_API}/repos/{repo}/contents/{path}"
-    r = requests.get(url, headers=_headers(token), params={"ref": branch}, timeout=30)
+    key = (repo, path, branch)
+    headers = _headers(token)
+    cached = _ETAG_CACHE.get(key)
+    if cached:
+        headers["If-None-Match"] = cached[0]
+
+    r = _SESSION.get(url, headers=headers, params={"ref": branch}, timeout=30)
+    if r.status_code == 304 and cached:
+        # não mudou: sem corpo na resposta e sem gastar rate limit
+        return dict(cached[1])
     if r.status_code == 404:
+        _ETAG_CACHE.pop(key, None)
         return {"exists": False}
     r.raise_for_status()
     data = r.json()
-    return {
+    info = {
         "exists": True,
         "sha": data.get("sha"),
         "content": data.get("content"),
         "encoding": data.get("encoding"),
     }
+    etag = r.headers.get("ETag")
+    if etag:
+        _ETAG_CACHE[key] = (etag, info)
+    return info
+
+
+def _current_sha(repo: str, path: str, token: str, branch: str) -> Optional[str]:
+    existing = github_get_file(repo=repo, path=path, token=token, branch=branch)
+    if existing.get("exists") and existing.get("sha"):
+        return existing["sha"]
+    return None
 
 
 def github_put_file(
@@ -41,12 +72,13 @@ def github_put_file(
     branch: str,
     content_bytes: bytes,
     commit_message: str,
-) -> None:
+    sha: Optional[str] = None,
+) -> Optional[str]:
     """
     Cria ou atualiza um arquivo no repo via Contents API (Create or update file contents). [1](https://github.com/meggavenda-dev/cirurgias/blob/main/seguran%C3%A7a.py)
+    Se o sha atual já for conhecido, pula o GET; devolve o sha novo do arquivo.
     """
     url = f"{GITHUB_API}/repos/{repo}/contents/{path}"
-    existing = github_get_file(repo=repo, path=path, token=token, branch=branch)
 
     payload = {
         "message": commit_message,
@@ -55,11 +87,23 @@ def github_put_file(
     }
 
     # quando atualiza, precisa enviar o sha atual
-    if existing.get("exists") and existing.get("sha"):
-        payload["sha"] = existing["sha"]
+    if sha is None:
+        sha = _current_sha(repo=repo, path=path, token=token, branch=branch)
+    if sha:
+        payload["sha"] = sha
+
+    r = _SESSION.put(url, headers=_headers(token), data=orjson.dumps(payload), timeout=30)
+
+    # sha em cache desatualizado: busca o atual e tenta uma única vez de novo
+    if r.status_code == 409:
+        sha = _current_sha(repo=repo, path=path, token=token, branch=branch)
+        payload.pop("sha", None)
+        if sha:
+            payload["sha"] = sha
+        r = _SESSION.put(url, headers=_headers(token), data=orjson.dumps(payload), timeout=30)
 
-    r = requests.put(url, headers=_headers(token), data=json.dumps(payload), timeout=30)
     r.raise_for_status()
+    return (r.json().get("content") or {}).get("sha")
 
 
 def github_get_json(repo: str, path: str, token: str, branch: str = "main", default=None):
@@ -73,19 +117,11 @@ def github_get_json(repo: str, path: str, token: str, branch: str = "main", defa
 
     raw = base64.b64decode(file_info["content"])
     try:
-        return json.loads(raw.decode("utf-8"))
+        return orjson.loads(raw)
     except Exception:
         return default
 
 
-def github_put_json(repo: str, path: str, token: str, branch: str, data, commit_message: str):
-    """Salva um dict/list como JSON no GitHub."""
-    content = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
-    github_put_file(
-        repo=repo,
-        path=path,
-        token=token,
-        branch=branch,
-        content_bytes=content,
-        commit_message=commit_message,
-    )
+def dumps_json(data) -> bytes:
+    """Serializa um dict/list no formato do arquivo salvo (UTF-8, indentado com 2 espaços)."""
+    return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)